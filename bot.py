@@ -1,93 +1,620 @@
+import asyncio
 import os
 import logging
-import google.generativai as genai
+import random
+import re
+import contextvars
+import hashlib
 import io
-import json
-from PIL import Image
-from telegram import Update, Bot
+import orjson
+import queue
+import difflib
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, TypedDict
+from telegram import Update
 from telegram.ext import (
-    Application, 
-    CommandHandler, 
-    MessageHandler, 
-    ContextTypes, 
+    Application,
+    CommandHandler,
+    MessageHandler,
+    ContextTypes,
     filters,
     ConversationHandler,
-    ApplicationBuilder
+    ApplicationBuilder,
+    ExtBot
 )
-from flask import Flask, request as flask_request, Response
+from telegram.request import HTTPXRequest
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse, PlainTextResponse, Response
+from starlette.routing import Route
+
+# uvloop's libuv-backed event loop has substantially lower per-await
+# and per-socket overhead than the default selector loop. Installed
+# before anything touches asyncio; optional so the bot still runs on
+# platforms without it (e.g. Windows dev machines).
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # --- Setup ---
+# WARNING by default in production; set LOG_LEVEL=INFO when debugging.
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
+    level=os.environ.get('LOG_LEVEL', 'WARNING').upper()
 )
 logger = logging.getLogger(__name__)
 
 # --- Load API Keys ---
-# Vercel uses Environment Variables.
-try:
-    TELEGRAM_BOT_TOKEN = os.environ['TELEGRAM_BOT_TOKEN']
-    GEMINI_API_KEY = os.environ['GEMINI_API_KEY']
-except KeyError:
-    logger.error("API keys not found! Set them in Vercel 'Environment Variables'.")
-    # Don't exit, as Vercel needs the app to be defined.
-    # We will just log the error.
-    TELEGRAM_BOT_TOKEN = None
-    GEMINI_API_KEY = None
+# Vercel uses Environment Variables. Validate them explicitly so the
+# log names every missing key at once (the old try/except KeyError
+# stopped at the first one and dragged in traceback machinery).
+# We still don't exit: Vercel needs the 'app' object to be defined,
+# so the web app below serves an error page instead.
+_missing_keys = [k for k in ('TELEGRAM_BOT_TOKEN', 'GEMINI_API_KEY') if k not in os.environ]
+if _missing_keys:
+    logger.error("Missing environment variables: %s. Set them in Vercel 'Environment Variables'.",
+                 ', '.join(_missing_keys))
+TELEGRAM_BOT_TOKEN = os.environ.get('TELEGRAM_BOT_TOKEN')
+GEMINI_API_KEY = os.environ.get('GEMINI_API_KEY')
+
+# Telegram lets a webhook answer with the API call itself in the HTTP
+# 200 body instead of making a separate outbound POST. The webhook
+# handler sets this to an empty list per update; a sendMessage produced
+# while it's set is captured and returned inline, halving the HTTP
+# round-trips for single-reply updates like /start and /split. The
+# inline body is only delivered after process_update returns, so the
+# moment a SECOND send happens in the same update the captured first
+# one is flushed as a real POST (preserving message order) and capture
+# stops — multi-reply flows never defer their messages.
+_inline_reply = contextvars.ContextVar('inline_reply', default=None)
+
+# Takes the captured payload's slot once capture is off for an update.
+_CAPTURE_DONE = object()
+
+class InlineReplyBot(ExtBot):
+    """ExtBot that diverts a sole send_message into the webhook response."""
+
+    async def send_message(self, chat_id, text, **kwargs):
+        captured = _inline_reply.get()
+        if captured is not None:
+            if not captured:
+                payload = {"method": "sendMessage", "chat_id": chat_id, "text": text}
+                if kwargs.get("parse_mode"):
+                    payload["parse_mode"] = kwargs["parse_mode"]
+                captured.append(payload)
+                # Handlers ignore the returned Message, so skipping the
+                # POST (and its Message echo) is safe here.
+                return None
+            first = captured[0]
+            if first is not _CAPTURE_DONE:
+                # Second send of this update: this is a multi-reply
+                # flow, so the held-back first message must go out NOW,
+                # ahead of this one, as an ordinary POST.
+                captured[0] = _CAPTURE_DONE
+                flush = dict(first)
+                flush.pop("method", None)
+                await super().send_message(**flush)
+        return await super().send_message(chat_id, text, **kwargs)
+
+def _disable_inline_reply():
+    """Opts the current update out of inline-reply capture.
+
+    Handlers that send an ack before slow work call this first, so the
+    ack goes out as an immediate POST (overlapping the download/model
+    call) instead of being held for the webhook response body.
+    """
+    captured = _inline_reply.get()
+    if captured is not None and not captured:
+        captured.append(_CAPTURE_DONE)
 
 # --- Bot & AI Setup ---
+# The Gemini SDK (and its native deps) cost hundreds of ms to import,
+# which every cold start paid even for text-only updates like /start.
+# Import and configure it lazily, memoized in a module-level singleton.
+_MODEL = None
+
+# Caps in-flight Gemini calls so a burst of users can't blow through
+# the per-account RPM quota; everything above the cap queues here
+# instead of surfacing as 429s.
+_GEMINI_SEMAPHORE = asyncio.Semaphore(8)
+
+def _get_model():
+    """Imports, configures, and caches the Gemini model on first use."""
+    global _MODEL
+    if _MODEL is None:
+        import google.generativai as genai
+        # REST transport keeps one keepalive HTTP session for the whole
+        # container instead of paying gRPC channel setup per call.
+        genai.configure(api_key=GEMINI_API_KEY, transport='rest')
+        _MODEL = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025')
+        logger.info("Gemini Model loaded")
+    return _MODEL
+
+async def _call_gemini(fn, *args, **kwargs):
+    """Awaits an async Gemini call with exponential backoff + jitter.
+
+    Transient failures (rate limits, 5xx, timeouts) get up to three
+    retries without the user re-uploading anything; auth and other
+    permanent errors propagate immediately. The semaphore is held only
+    around the call itself, not across backoff sleeps.
+    """
+    from google.api_core import exceptions as api_exceptions
+
+    transient = (
+        api_exceptions.ResourceExhausted,
+        api_exceptions.ServiceUnavailable,
+        api_exceptions.DeadlineExceeded,
+    )
+    for attempt in range(4):
+        try:
+            async with _GEMINI_SEMAPHORE:
+                return await fn(*args, **kwargs)
+        except transient as e:
+            if attempt == 3:
+                raise
+            delay = (2 ** attempt) + random.random()
+            logger.error("Transient Gemini error, retrying in %.1fs: %s", delay, e)
+            await asyncio.sleep(delay)
+
+async def _warmup_gemini():
+    """Sends a tiny ping so the first real request skips model warmup.
+
+    The first generate_content of a container pays auth token fetch and
+    connection setup (~0.5-2 s); doing it in the background during
+    initialization keeps that off a user's critical path. Failure is
+    logged but never fatal.
+    """
+    try:
+        await _call_gemini(_get_model().generate_content_async, "ping")
+        logger.info("Gemini warmed up")
+    except Exception as e:
+        logger.error("Gemini warmup failed: %s", e)
+
 if TELEGRAM_BOT_TOKEN and GEMINI_API_KEY:
-    genai.configure(api_key=GEMINI_API_KEY)
-    model = genai.GenerativeModel('gemini-2.5-flash-preview-09-2025')
-    bot = Bot(token=TELEGRAM_BOT_TOKEN)
-    application = ApplicationBuilder().bot(bot).build()
-    logger.info("Gemini Model loaded and Bot Application built")
+    # HTTP/2 + a generous keepalive pool: warm containers reuse
+    # multiplexed TLS connections to api.telegram.org, and concurrent
+    # photo downloads from the CDN stop serializing behind a few
+    # sockets.
+    application = (
+        ApplicationBuilder()
+        .bot(InlineReplyBot(
+            token=TELEGRAM_BOT_TOKEN,
+            request=HTTPXRequest(http_version="2", connection_pool_size=32),
+        ))
+        .build()
+    )
+    bot = application.bot
+    logger.info("Bot Application built")
 else:
     logger.error("Bot cannot start due to missing API keys.")
-    # We create a dummy 'app' so Vercel can at least build.
-    app = Flask(__name__)
-    @app.route('/')
-    def error_home():
-        return "Bot is OFFLINE. Missing API keys in Vercel Environment Variables.", 500
+    # Keep the module importable so Vercel can at least build; the web
+    # app below will serve an error page instead of the webhook.
+    application = None
+    bot = None
 
 
 # --- Conversation States ---
-RECEIVE_PHOTO, RECEIVE_ASSIGNMENTS = range(2)
+RECEIVE_PHOTO, RECEIVE_ASSIGNMENTS, RECEIVE_BATCH_PHOTOS = range(3)
+
+# --- Receipt Schema ---
+# Passed to Gemini's structured-output mode so the SDK guarantees the
+# response is valid JSON in exactly this shape.
+
+class BillItem(TypedDict):
+    name: str
+    price: float
+
+class BillSchema(TypedDict):
+    items: list[BillItem]
+    tax: float
+    service_charge: float
+    subtotal: float
+
+def _strip_code_fences(text: str) -> str:
+    """Removes a surrounding ```json fence, if present, with plain slices.
+
+    Structured output shouldn't produce fences, but this guard is two
+    O(1) slices — unlike the old lstrip("```json") idiom, which strips
+    a *character class* and could silently eat real leading data.
+    """
+    t = text.strip()
+    if t.startswith("```"):
+        t = t[7:] if t.startswith("```json") else t[3:]
+        if t.endswith("```"):
+            t = t[:-3]
+        t = t.strip()
+    return t
+
+# The welcome text never changes apart from the greeting, so build the
+# constant tail once at import instead of on every /start.
+_WELCOME_TAIL = (
+    "! I'm your AI-powered Split Bill Bot.\n\n"
+    "**Here's the powerful way to split a bill:**\n\n"
+    "1.  **Send me a photo** of your itemized receipt.\n"
+    "2.  I'll read all the items, tax, and service charge.\n"
+    "3.  I'll ask you who ate what.\n"
+    "4.  You reply with who had which items (e.g., `Alice: Burger. Bob: Salad, Fries`)\n"
+    "5.  I'll calculate the *exact* amount each person owes, including their share of tax & service!\n\n"
+    "**Other commands:**\n"
+    "*/split [total] [people]* - Quick manual split.\n"
+    "*/split_batch* - Total up a whole stack of receipts at once.\n"
+    "*/gemini [question]* - Ask my AI brain anything.\n"
+    "*/cancel* - Cancel the current bill splitting conversation."
+)
+
+# --- Receipt Image Preprocessing ---
+
+# Gemini's receipt OCR quality is flat below ~1024px on the long edge;
+# anything bigger is wasted upload bytes and image tokens.
+_MAX_OCR_EDGE = 1024
+
+def _best_photo(photos):
+    """Picks the smallest Telegram size still at/above the OCR ceiling.
+
+    Telegram offers each photo in several sizes, ordered small to
+    large. Grabbing the smallest adequate one downloads (and decodes)
+    far fewer bytes than always taking photos[-1].
+    """
+    for photo in photos:
+        if max(photo.width, photo.height) >= _MAX_OCR_EDGE:
+            return photo
+    return photos[-1]
+
+# Reusable output buffers for the re-encode step. Fresh multi-MB
+# BytesIO allocations per photo churn the allocator under concurrent
+# load; a small pool lets warm buffers be reused instead. Preprocessing
+# runs in to_thread workers, so this is a thread-safe queue rather than
+# an asyncio primitive.
+_ENCODE_BUF_POOL = queue.SimpleQueue()
+_ENCODE_BUF_MAX = 8
+
+def _borrow_buffer() -> io.BytesIO:
+    try:
+        return _ENCODE_BUF_POOL.get_nowait()
+    except queue.Empty:
+        return io.BytesIO()
+
+def _return_buffer(buf: io.BytesIO) -> None:
+    if _ENCODE_BUF_POOL.qsize() < _ENCODE_BUF_MAX:
+        buf.seek(0)
+        buf.truncate()
+        _ENCODE_BUF_POOL.put(buf)
+
+def _jpeg_dimensions(buf) -> Optional[tuple]:
+    """Reads (width, height) straight from a JPEG's SOF marker.
+
+    A few hundred bytes of marker scanning answers "is it already small
+    enough?" without the O(W*H) libjpeg decode. Returns None for
+    anything it can't parse, in which case the caller decodes normally.
+    """
+    data = bytes(buf[:65536])
+    if data[:2] != b'\xff\xd8':
+        return None
+    i = 2
+    while i + 9 < len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        # Standalone markers carry no length field.
+        if marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            i += 2
+            continue
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        # SOF0..SOF15 hold the frame size (C4/C8/CC are not SOFs).
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            height = int.from_bytes(data[i + 5:i + 7], 'big')
+            width = int.from_bytes(data[i + 7:i + 9], 'big')
+            return (width, height)
+        i += 2 + length
+    return None
+
+def _decode_and_preprocess(buf: io.BytesIO) -> dict:
+    """Decodes, downscales, and binarizes a receipt photo.
+
+    Returns a Gemini inline image part. CPU-bound (PIL holds the GIL),
+    so callers should run it via asyncio.to_thread to avoid stalling
+    other updates on the event loop.
+    """
+    # Imported here so text-only invocations never pay PIL's import cost.
+    from PIL import Image, ImageChops, ImageFilter, ImageOps
+
+    img = Image.open(buf)
+
+    img.thumbnail((_MAX_OCR_EDGE, _MAX_OCR_EDGE), Image.Resampling.LANCZOS)
+    img = img.convert("RGB")
+
+    # Receipts are black ink on white paper: grayscale + a threshold
+    # reads better than the color original and a 1-bit PNG compresses
+    # ~5x smaller. The threshold is local — each pixel is compared
+    # against a blurred copy of its neighbourhood — so a shadow across
+    # half the receipt shifts the background estimate with it instead
+    # of blackening that half wholesale. If anything goes wrong (odd
+    # modes, decode errors), fall back to the plain JPEG so the photo
+    # still gets processed.
+    out = _borrow_buffer()
+    try:
+        try:
+            gray = ImageOps.autocontrast(img.convert("L"))
+            background = gray.filter(ImageFilter.BoxBlur(15))
+            ink = ImageChops.subtract(background, gray)
+            mono = ink.point(lambda p: 0 if p > 10 else 255, mode="1")
+            mono.save(out, format="PNG", optimize=True)
+            return {"mime_type": "image/png", "data": out.getvalue()}
+        except Exception as e:
+            logger.error("Receipt preprocessing failed, using original: %s", e)
+            out.seek(0)
+            out.truncate()
+            img.save(out, format="JPEG", quality=80)
+            return {"mime_type": "image/jpeg", "data": out.getvalue()}
+    finally:
+        _return_buffer(out)
+
+async def _photo_image_part(photo) -> dict:
+    """Downloads a Telegram photo and returns a Gemini inline part.
+
+    Telegram already reports width/height in the PhotoSize metadata, so
+    photos at or under the OCR ceiling skip PIL entirely — no libjpeg
+    decode, no pixel buffer, just the downloaded bytes passed through.
+    Larger photos go through the full preprocessing pipeline.
+    """
+    photo_file = await photo.get_file()
+    raw = await photo_file.download_as_bytearray()
+    long_edge = max(photo.width or 0, photo.height or 0)
+    if not long_edge:
+        # No metadata (e.g. photo sent as a document): read the size
+        # from the JPEG header instead of decoding the whole image.
+        dimensions = _jpeg_dimensions(raw)
+        if dimensions:
+            long_edge = max(dimensions)
+    if long_edge and long_edge <= _MAX_OCR_EDGE:
+        return {"mime_type": "image/jpeg", "data": bytes(raw)}
+    return await asyncio.to_thread(_decode_and_preprocess, io.BytesIO(bytes(raw)))
+
+# --- Gemini File Cache ---
+# Retries of the same receipt (blurry-photo do-overs, re-splits) were
+# re-sending the same multi-MB inline payload to Gemini every time.
+# Upload once via the Files API and key the handle by content hash so a
+# duplicate upload is a no-op; the prompt then carries a tiny URI.
+_FILE_CACHE = OrderedDict()
+_FILE_CACHE_MAX = 128
+
+def _upload_receipt(image_part: dict):
+    """Uploads an image to the Gemini Files API, memoized by SHA-256.
+
+    Synchronous network I/O — run via asyncio.to_thread from handlers.
+    Evicts least-recently-used handles (deleting them server-side) to
+    stay under the Files API storage quota.
+    """
+    _get_model()  # ensures genai is imported and configured
+    import google.generativai as genai
+
+    h = hashlib.sha256(image_part["data"]).hexdigest()
+    cached = _FILE_CACHE.get(h)
+    if cached is not None:
+        _FILE_CACHE.move_to_end(h)
+        return cached
+
+    uploaded = genai.upload_file(io.BytesIO(image_part["data"]), mime_type=image_part["mime_type"])
+    _FILE_CACHE[h] = uploaded
+    if len(_FILE_CACHE) > _FILE_CACHE_MAX:
+        _, evicted = _FILE_CACHE.popitem(last=False)
+        try:
+            genai.delete_file(evicted.name)
+        except Exception as e:
+            logger.error("Could not delete evicted Gemini file: %s", e)
+    return uploaded
+
+# --- Extraction Micro-Batcher ---
+# Photos from different users that arrive within a ~50 ms window are
+# coalesced into ONE multi-image Gemini call, amortizing per-request
+# overhead (auth, connection, prompt tokens) across the whole batch.
+# A lone photo waits at most the window before going out solo.
+_OCR_QUEUE = asyncio.Queue()
+_OCR_BATCH_MAX = 8
+_OCR_BATCH_WINDOW = 0.05  # seconds
+_ocr_worker_task = None
+
+_EXTRACT_PROMPT = (
+    "You are an expert receipt scanner. For EACH receipt image, in order, "
+    "extract all itemized items, their prices, and any tax and service charges. "
+    "If you cannot find items, tax, or service, set their value to 0.00. "
+    "Return one bill object per receipt, in order."
+)
+
+_RECEIPT_MODEL = None
+
+def _get_receipt_model():
+    """Extraction model with the scanner prompt baked in, memoized.
+
+    system_instruction keeps the instructions out of every request
+    payload (and lets the server cache them), and the preconfigured
+    generation_config means callers just send images.
+    """
+    global _RECEIPT_MODEL
+    if _RECEIPT_MODEL is None:
+        _get_model()  # ensures genai is imported and configured
+        import google.generativai as genai
+        _RECEIPT_MODEL = genai.GenerativeModel(
+            'gemini-2.5-flash-preview-09-2025',
+            system_instruction=_EXTRACT_PROMPT,
+            generation_config={
+                "response_mime_type": "application/json",
+                "response_schema": list[BillSchema],
+            },
+        )
+    return _RECEIPT_MODEL
+
+async def _ocr_worker():
+    """Drains the queue in small time-windowed batches, one call each."""
+    while True:
+        batch = [await _OCR_QUEUE.get()]
+        while len(batch) < _OCR_BATCH_MAX:
+            try:
+                batch.append(await asyncio.wait_for(_OCR_QUEUE.get(), _OCR_BATCH_WINDOW))
+            except asyncio.TimeoutError:
+                break
+        try:
+            response = await _call_gemini(
+                _get_receipt_model().generate_content_async,
+                [part for _, part in batch],
+            )
+            bills = orjson.loads(_strip_code_fences(response.text))
+            for (future, _), bill in zip(batch, bills):
+                if not future.done():
+                    future.set_result(bill)
+            for future, _ in batch[len(bills):]:
+                if not future.done():
+                    future.set_exception(ValueError("Gemini returned no bill for this receipt"))
+        except Exception as e:
+            for future, _ in batch:
+                if not future.done():
+                    future.set_exception(e)
+
+async def extract_bill(image_part) -> dict:
+    """Extracts one receipt's bill data via the shared micro-batcher."""
+    global _ocr_worker_task
+    if _ocr_worker_task is None or _ocr_worker_task.done():
+        _ocr_worker_task = asyncio.create_task(_ocr_worker())
+    future = asyncio.get_running_loop().create_future()
+    await _OCR_QUEUE.put((future, image_part))
+    return await future
+
+# Compiled once at import; matches the first money-like token in a
+# string so "/split $150.75 3", "1,000.50", and "150,75" all parse in
+# one C-level scan instead of failing float() outright. A comma only
+# counts as a decimal separator when followed by 1-2 non-digit-trailed
+# digits; ",ddd" runs are consumed as thousands grouping.
+_NUM_RE = re.compile(r'[-+]?(?:\d{1,3}(?:,\d{3})+|\d+)(?:\.\d+|,\d{1,2}(?!\d))?')
+_GROUPED_RE = re.compile(r'[-+]?\d{1,3}(?:,\d{3})+(?:\.\d+)?$')
+
+def _parse_amount(text: str) -> Optional[float]:
+    """Extracts the first money token from text ('$1,000.50' -> 1000.5)."""
+    m = _NUM_RE.search(text)
+    if not m:
+        return None
+    token = m.group(0)
+    if ',' in token:
+        # "1,000" / "1,000.50" are grouping; "150,75" is a decimal.
+        token = token.replace(',', '') if _GROUPED_RE.match(token) else token.replace(',', '.')
+    return float(token)
+
+# --- Bill Splitting Math ---
+# The split itself is ~30 lines of arithmetic; doing it locally removes
+# a full Gemini round-trip (and its non-determinism on money) from every
+# bill. Gemini remains a fallback for assignments we fail to parse.
+
+def parse_assignments(text: str) -> dict[str, list[str]]:
+    """Parses 'Alice: Burger, Fries' lines into {person: [item names]}."""
+    assignments = {}
+    for line in text.splitlines():
+        person, sep, items = line.partition(':')
+        if not sep:
+            continue
+        person = person.strip()
+        names = [n.strip() for n in items.split(',') if n.strip()]
+        if person and names:
+            assignments[person] = names
+    return assignments
+
+@lru_cache(maxsize=4096)
+def _canonical_item(name_lower: str, item_names: tuple) -> Optional[str]:
+    """Fuzzy-matches a user-typed name to a receipt item, memoized.
+
+    The same item gets referenced by every diner in a split (and again
+    on re-splits of the same receipt), so repeat lookups become dict
+    hits instead of O(N*M) sequence matching.
+    """
+    matches = difflib.get_close_matches(name_lower, item_names, n=1, cutoff=0.6)
+    return matches[0] if matches else None
+
+def compute_split(bill_data: dict, assignments: dict) -> Optional[str]:
+    """Computes each person's share locally.
+
+    Returns the formatted Markdown breakdown, or None if any item name
+    can't be fuzzily matched (the caller then falls back to Gemini).
+    """
+    item_prices = {}
+    for item in bill_data['items']:
+        name = item['name'].lower()
+        price = float(item['price'])
+        if name in item_prices and item_prices[name] != price:
+            # Two "beer" lines at different prices: "beer" is ambiguous
+            # locally, so let Gemini sort out the full receipt instead.
+            return None
+        item_prices[name] = price
+    item_names = tuple(item_prices)  # hashable, so _canonical_item can cache
+    people = [p for p in assignments if p.lower() not in ('everyone', 'share')]
+    if not people:
+        return None
+
+    subtotals = dict.fromkeys(people, 0.0)
+    for person, names in assignments.items():
+        shared = person.lower() in ('everyone', 'share')
+        for name in names:
+            match = _canonical_item(name.lower(), item_names)
+            if match is None:
+                return None
+            price = item_prices[match]
+            if shared:
+                for p in people:
+                    subtotals[p] += price / len(people)
+            else:
+                subtotals[person] += price
+
+    assigned_total = sum(subtotals.values())
+    if assigned_total <= 0:
+        return None
+
+    tax = float(bill_data.get('tax') or 0.0)
+    service = float(bill_data.get('service_charge') or 0.0)
+    lines = ["**Here's the split:**\n"]
+    for person in people:
+        share = subtotals[person] / assigned_total
+        owed = subtotals[person] + share * (tax + service)
+        lines.append(
+            f"**{person}** pays **${owed:,.2f}**\n"
+            f"  (items ${subtotals[person]:,.2f} + tax ${share * tax:,.2f}"
+            f" + service ${share * service:,.2f})"
+        )
+    return "\n".join(lines)
 
 # --- Bot Command Functions ---
 
 async def start_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sends a welcome message when the /start command is issued."""
     user = update.effective_user
-    welcome_message = (
-        f"Hi {user.first_name}! I'm your AI-powered Split Bill Bot.\n\n"
-        "**Here's the powerful way to split a bill:**\n\n"
-        "1.  **Send me a photo** of your itemized receipt.\n"
-        "2.  I'll read all the items, tax, and service charge.\n"
-        "3.  I'll ask you who ate what.\n"
-        "4.  You reply with who had which items (e.g., `Alice: Burger. Bob: Salad, Fries`)\n"
-        "5.  I'll calculate the *exact* amount each person owes, including their share of tax & service!\n\n"
-        "**Other commands:**\n"
-        "*/split [total] [people]* - Quick manual split.\n"
-        "*/gemini [question]* - Ask my AI brain anything.\n"
-        "*/cancel* - Cancel the current bill splitting conversation."
-    )
-    await update.message.reply_text(welcome_message, parse_mode='Markdown')
+    await update.message.reply_text(f"Hi {user.first_name}{_WELCOME_TAIL}", parse_mode='Markdown')
 
 async def split_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Splits the bill based on user input (the simple, manual way)."""
     try:
-        total_amount = float(context.args[0])
+        total_amount = _parse_amount(context.args[0])
         num_people = int(context.args[1])
 
+        if total_amount is None:
+            raise ValueError(f"no amount in {context.args[0]!r}")
+        if total_amount <= 0:
+            # Also keeps negatives away from the floor-division
+            # formatter below, which only renders non-negative cents.
+            await update.message.reply_text("The total must be more than $0!")
+            return
         if num_people <= 0:
             await update.message.reply_text("Number of people must be at least 1!")
             return
 
-        split_amount = total_amount / num_people
-        result_message = f"Total: ${total_amount:,.2f}\n"
-        result_message += f"Split between {num_people} people:\n"
-        result_message += f"Each person pays: ${split_amount:,.2f}"
+        # Integer cents: float division silently loses money
+        # ($33.33 x 3 != $100.00); divmod keeps every cent accounted for.
+        cents = int(round(total_amount * 100))
+        per_person, remainder = divmod(cents, num_people)
+        result_message = (
+            f"Total: ${cents // 100:,}.{cents % 100:02d}\n"
+            f"Split between {num_people} people:\n"
+            f"Each person pays: ${per_person // 100:,}.{per_person % 100:02d}"
+        )
+        if remainder:
+            result_message += f"\n({remainder} leftover cent{'s' if remainder > 1 else ''} — someone covers the rounding!)"
         await update.message.reply_text(result_message)
 
     except (IndexError, ValueError):
@@ -97,23 +624,30 @@ async def split_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
             "Example: `/split 150.75 3`"
         )
     except Exception as e:
-        logger.error(f"Error in /split: {e}")
+        logger.error("Error in /split: %s", e)
         await update.message.reply_text("Sorry, I had trouble calculating that.")
 
 async def gemini_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sends the user's question to the Gemini AI."""
-    question = ' '.join(context.args) # All text after the command
+    # Everything after the command in one pass, instead of re-joining the
+    # arg tokens PTB already split for us. split(maxsplit=1) treats any
+    # whitespace as the separator, so "/gemini\nquestion" works too.
+    parts = update.message.text.split(maxsplit=1)
+    question = parts[1].strip() if len(parts) > 1 else ''
     if not question:
         await update.message.reply_text("Please ask a question after /gemini.\n"
                                         "Example: `/gemini How to save money?`")
         return
     
+    # Two replies follow (ack + answer); send the ack straight away
+    # rather than letting capture hold it for the webhook body.
+    _disable_inline_reply()
     await update.message.reply_text("Asking my AI brain... 🧠")
     try:
-        response = model.generate_content(question)
+        response = await _call_gemini(_get_model().generate_content_async, question)
         await update.message.reply_text(response.text)
     except Exception as e:
-        logger.error(f"Error calling Gemini: {e}")
+        logger.error("Error calling Gemini: %s", e)
         await update.message.reply_text("Sorry, my AI brain is a bit foggy. Please try again.")
 
 # --- Bill Splitting Conversation Functions ---
@@ -123,31 +657,29 @@ async def start_bill_split_convo(update: Update, context: ContextTypes.DEFAULT_T
     STARTS the conversation.
     This is triggered when a user sends a photo.
     """
-    await update.message.reply_text("Got your photo! Reading the bill with AI... 📸")
-    
+    # This handler is pure network I/O (Telegram download, Gemini call,
+    # Telegram reply), so fire the ack as a task and let it fly in
+    # parallel with the photo download instead of serializing in front.
+    # Capture must be off first, or the ack would be held back for the
+    # webhook body and the overlap would never leave the process.
+    _disable_inline_reply()
+    ack_task = asyncio.create_task(
+        update.message.reply_text("Got your photo! Reading the bill with AI... 📸")
+    )
+
     try:
-        photo_file = await update.message.photo[-1].get_file()
-        file_bytes_io = io.BytesIO()
-        await photo_file.download_to_memory(file_bytes_io)
-        file_bytes_io.seek(0)
-        img = Image.open(file_bytes_io)
-
-        prompt = [
-            "You are an expert receipt scanner. Analyze this image and extract all itemized items, their prices, "
-            "and any tax and service charges. "
-            "Respond *ONLY* with a valid JSON object in this exact format: "
-            '{"items": [{"name": "Item Name", "price": 12.50}, {"name": "Another Item", "price": 8.00}], '
-            '"tax": 1.50, "service_charge": 2.00, "subtotal": 20.50}'
-            " If you cannot find items, tax, or service, set their value to 0.00. "
-            "Do not include any other text before or after the JSON.",
-            img
-        ]
-        
-        response = model.generate_content(prompt)
-        # Clean the response to get only the JSON
-        json_text = response.text.strip().lstrip("```json").rstrip("```").lstrip("```")
-        bill_data = json.loads(json_text)
-        
+        image_part = await _photo_image_part(_best_photo(update.message.photo))
+        # Upload (or reuse) the image server-side; retries of the same
+        # receipt skip the multi-MB inline payload entirely.
+        receipt_file = await asyncio.to_thread(_upload_receipt, image_part)
+
+        # Extraction goes through the shared micro-batcher, which fuses
+        # photos arriving close together into one multi-image call.
+        bill_data = await extract_bill(receipt_file)
+        # The ack has had the whole model call to complete; settle it
+        # before sending anything else so messages arrive in order.
+        await ack_task
+
         if "items" not in bill_data or not bill_data["items"]:
             await update.message.reply_text("Sorry, I couldn't find any items on that receipt. Please try a clearer photo.")
             return ConversationHandler.END
@@ -155,10 +687,12 @@ async def start_bill_split_convo(update: Update, context: ContextTypes.DEFAULT_T
         # Store the bill data in the conversation context
         context.user_data['bill_data'] = bill_data
         
-        item_list = ""
-        for i, item in enumerate(bill_data['items']):
-            item_list += f"{i+1}. {item['name']} - ${item['price']:.2f}\n"
-        
+        item_list = "".join(
+            f"{i+1}. {item['name']} - ${item['price']:.2f}\n"
+            for i, item in enumerate(bill_data['items'])
+        )
+
+
         summary_message = (
             "OK, I've read the bill! Here's what I found:\n\n"
             f"**Items:**\n{item_list}\n"
@@ -177,7 +711,8 @@ async def start_bill_split_convo(update: Update, context: ContextTypes.DEFAULT_T
         return RECEIVE_ASSIGNMENTS
 
     except Exception as e:
-        logger.error(f"Error in start_bill_split_convo: {e}")
+        logger.error("Error in start_bill_split_convo: %s", e)
+        await asyncio.gather(ack_task, return_exceptions=True)
         await update.message.reply_text("Sorry, I had trouble reading that receipt. Please try a clearer photo or type /cancel to stop.")
         return ConversationHandler.END
 
@@ -193,11 +728,29 @@ async def receive_assignments(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("Oops! Something went wrong. Please send the photo again to start over.")
         return ConversationHandler.END
 
-    await update.message.reply_text("Got it! Calculating the split... 🧮")
-    
+    # Same trick as the photo handler: let the ack overlap the
+    # computation (and the Gemini fallback) instead of preceding it.
+    _disable_inline_reply()
+    ack_task = asyncio.create_task(
+        update.message.reply_text("Got it! Calculating the split... 🧮")
+    )
+
+    # Try the local computation first; only fall through to Gemini when
+    # the parser or fuzzy matcher can't make sense of the assignments.
+    assignments = parse_assignments(assignments_text)
+    breakdown = compute_split(bill_data, assignments) if assignments else None
+    if breakdown is not None:
+        await ack_task
+        await update.message.reply_text(breakdown, parse_mode='Markdown')
+        context.user_data.clear()
+        return ConversationHandler.END
+
+    # Extraction runs through the shared micro-batcher rather than a
+    # per-user chat session, so this (rare) fallback has to carry the
+    # bill JSON itself.
     calculation_prompt = (
         "You are an expert bill splitting calculator. I will give you a JSON of bill data and a text of assignments.\n\n"
-        f"**Bill Data (JSON):**\n{json.dumps(bill_data)}\n\n"
+        f"**Bill Data (JSON):**\n{orjson.dumps(bill_data).decode()}\n\n"
         f"**Assignments (Text):**\n{assignments_text}\n\n"
         "**Your Task:**\n"
         "1.  Calculate the subtotal for each person based on the items they were assigned. Match item names fuzzily (e.g., 'Burger' matches 'burger').\n"
@@ -209,17 +762,81 @@ async def receive_assignments(update: Update, context: ContextTypes.DEFAULT_TYPE
     )
 
     try:
-        response = model.generate_content(calculation_prompt)
+        response = await _call_gemini(_get_model().generate_content_async, calculation_prompt)
+        await ack_task
         await update.message.reply_text(response.text, parse_mode='Markdown')
 
     except Exception as e:
-        logger.error(f"Error in receive_assignments (calculation): {e}")
+        logger.error("Error in receive_assignments (calculation): %s", e)
+        await asyncio.gather(ack_task, return_exceptions=True)
         await update.message.reply_text("Sorry, I had trouble with the final calculation. Please try again.")
 
     # End the conversation
     context.user_data.clear()
     return ConversationHandler.END
 
+# --- Batch Receipt Functions ---
+# The cost-dominant axis for heavy users (end-of-month reconciliation)
+# is Gemini calls per receipt. /split_batch collects a whole stack of
+# photos and totals them in ONE multi-image call, amortizing the
+# per-request overhead across every receipt in the batch.
+
+async def split_batch_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """STARTS the batch totalling conversation."""
+    context.user_data['batch_parts'] = []
+    await update.message.reply_text(
+        "Batch mode! 📚 Send me your receipt photos one by one.\n"
+        "When you're done, send /done and I'll total them all up in one go.\n"
+        "(/cancel to stop.)"
+    )
+    return RECEIVE_BATCH_PHOTOS
+
+async def receive_batch_photo(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Collects one receipt photo into the pending batch."""
+    try:
+        image_part = await _photo_image_part(_best_photo(update.message.photo))
+        context.user_data['batch_parts'].append(image_part)
+        count = len(context.user_data['batch_parts'])
+        await update.message.reply_text(f"Got receipt #{count}. Send more, or /done to total them.")
+    except Exception as e:
+        logger.error("Error in receive_batch_photo: %s", e)
+        await update.message.reply_text("Sorry, I couldn't read that one. Try again or send /done.")
+    return RECEIVE_BATCH_PHOTOS
+
+async def batch_done_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Totals every collected receipt with a single Gemini call."""
+    parts = context.user_data.get('batch_parts') or []
+    if not parts:
+        await update.message.reply_text("You haven't sent me any receipts yet! Send a photo, or /cancel.")
+        return RECEIVE_BATCH_PHOTOS
+
+    # Ack + totals are two replies; make the ack an immediate POST.
+    _disable_inline_reply()
+    await update.message.reply_text(f"Totalling {len(parts)} receipt(s) in one go... 🧮")
+
+    try:
+        # The scanner prompt and JSON schema are baked into the receipt
+        # model, so the request is just the stack of images.
+        response = await _call_gemini(_get_receipt_model().generate_content_async, parts)
+        bills = orjson.loads(_strip_code_fences(response.text))
+
+        grand_total = 0.0
+        lines = ["**Batch totals:**\n"]
+        for i, bill in enumerate(bills):
+            items_total = sum(float(item['price']) for item in bill.get('items', []))
+            receipt_total = items_total + float(bill.get('tax') or 0.0) + float(bill.get('service_charge') or 0.0)
+            grand_total += receipt_total
+            lines.append(f"{i+1}. ${receipt_total:,.2f} ({len(bill.get('items', []))} items)")
+        lines.append(f"\n**Grand total: ${grand_total:,.2f}**")
+        await update.message.reply_text("\n".join(lines), parse_mode='Markdown')
+
+    except Exception as e:
+        logger.error("Error in batch_done_command: %s", e)
+        await update.message.reply_text("Sorry, I had trouble totalling those receipts. Please try again.")
+
+    context.user_data.clear()
+    return ConversationHandler.END
+
 async def cancel_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Cancels and ends the conversation."""
     await update.message.reply_text(
@@ -232,9 +849,10 @@ async def unknown_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handles any command that the bot doesn't recognize."""
     await update.message.reply_text("Sorry, I don't understand that command. Type /start to see what I can do!")
 
-# --- Flask Web Server ---
-# This is the "app" that Vercel will run.
-app = Flask(__name__)
+# --- ASGI Web App ---
+# This is the "app" that Vercel will run. Starlette is ASGI, so the
+# async webhook handler runs natively on one persistent event loop
+# instead of being bridged through a WSGI request cycle per update.
 
 if application: # Only set up handlers if the bot initialized correctly
     # --- Setup Handlers (No Polling) ---
@@ -245,31 +863,88 @@ if application: # Only set up handlers if the bot initialized correctly
         },
         fallbacks=[CommandHandler("cancel", cancel_command)],
     )
+    batch_split_handler = ConversationHandler(
+        entry_points=[CommandHandler("split_batch", split_batch_command)],
+        states={
+            RECEIVE_BATCH_PHOTOS: [
+                MessageHandler(filters.PHOTO, receive_batch_photo),
+                CommandHandler("done", batch_done_command),
+            ],
+        },
+        fallbacks=[CommandHandler("cancel", cancel_command)],
+    )
+    # Registered before the single-bill handler so batch-mode photos
+    # aren't swallowed by its bare photo entry point.
+    application.add_handler(batch_split_handler)
     application.add_handler(bill_split_handler)
     application.add_handler(CommandHandler("start", start_command))
     application.add_handler(CommandHandler("split", split_command))
     application.add_handler(CommandHandler("gemini", gemini_command))
     application.add_handler(MessageHandler(filters.COMMAND, unknown_command))
 
-    @app.route('/')
-    def home():
+    async def home(request):
         """A simple page to show the bot is alive."""
-        return "Hello! Your SplitBill AI Bot is alive and running."
+        return PlainTextResponse("Hello! Your SplitBill AI Bot is alive and running.")
+
+    async def set_webhook(request):
+        """Registers this deployment's URL with Telegram (hit once after deploy)."""
+        public_host = os.environ.get('PUBLIC_URL') or os.environ.get('VERCEL_URL')
+        if not public_host:
+            return PlainTextResponse("Cannot set webhook: PUBLIC_URL / VERCEL_URL not set.", status_code=500)
+        if not public_host.startswith('http'):
+            public_host = f"https://{public_host}"
+        webhook_url = f"{public_host}/{TELEGRAM_BOT_TOKEN}"
+        await bot.set_webhook(url=webhook_url, allowed_updates=Update.ALL_TYPES)
+        logger.info("Webhook set")
+        return PlainTextResponse("Webhook registered.")
+
+    # Initialized once per warm container; cold starts pay this on the
+    # first update only, every later invocation reuses the warm pool.
+    _initialized = False
+
+    async def _ensure_initialized():
+        global _initialized
+        if not _initialized:
+            await application.initialize()
+            # Fire-and-forget: warms Gemini auth + connection while the
+            # first update is still being handled.
+            asyncio.create_task(_warmup_gemini())
+            _initialized = True
 
-    @app.route(f'/{TELEGRAM_BOT_TOKEN}', methods=['POST'])
-    async def webhook():
+    async def webhook(request):
         """This is the main function that receives updates from Telegram."""
-        update_data = flask_request.get_json()
+        await _ensure_initialized()
+        update_data = await request.json()
         update = Update.de_json(data=update_data, bot=bot)
-        
-        logger.info(f"Received update: {update.update_id}")
-        
+
+        logger.info("Received update: %s", update.update_id)
+
+        token = _inline_reply.set([])
         try:
             await application.process_update(update)
         except Exception as e:
-            logger.error(f"Error processing update: {e}")
-            
-        return Response(status=200)
+            logger.error("Error processing update: %s", e)
+        finally:
+            captured = _inline_reply.get()
+            _inline_reply.reset(token)
+
+        if captured and captured[0] is not _CAPTURE_DONE:
+            # Single-reply update: answer Telegram with the reply
+            # itself — no outbound POST was needed at all.
+            return JSONResponse(captured[0])
+        return Response(status_code=200)
+
+    routes = [
+        Route('/', home),
+        Route('/set_webhook', set_webhook),
+        Route(f'/{TELEGRAM_BOT_TOKEN}', webhook, methods=['POST']),
+    ]
+else:
+    async def error_home(request):
+        return PlainTextResponse("Bot is OFFLINE. Missing API keys in Vercel Environment Variables.", status_code=500)
+
+    routes = [Route('/', error_home)]
 
 # Vercel needs to know what 'app' is.
-# This file will be run, and Vercel will find the 'app' object.
\ No newline at end of file
+# This file will be run, and Vercel will find the 'app' object.
+app = Starlette(routes=routes)
\ No newline at end of file